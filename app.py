@@ -1,6 +1,8 @@
 # app.py — Dukaan-Dost (updated)
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
 import matplotlib
 matplotlib.use('Agg')   # use non-GUI backend (fixes "main thread is not in main loop")
@@ -8,8 +10,17 @@ import matplotlib.pyplot as plt
 from flask import Flask, request
 from dotenv import load_dotenv
 import threading
+import atexit
+import csv
+import time
+import io
+import hashlib
 from filelock import FileLock
 import datetime
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
+import orjson
+import queue
 
 # Load environment
 load_dotenv()
@@ -23,9 +34,15 @@ VERIFY_TOKEN = os.getenv("WEBHOOK_VERIFY_TOKEN")
 ADMIN_PIN = "1234"
 
 # State
-user_sessions = {}     # per-phone session states
+# Session state expires so phones that chatted once don't stay in memory forever.
+# TTLCache is not thread-safe (even reads may evict), so every access goes through _state_lock.
+_state_lock = threading.Lock()
+user_sessions = TTLCache(maxsize=10_000, ttl=1800)  # per-phone session states (30 min)
 admin_numbers = set()  # phone numbers in admin/owner mode
-last_order_status = {} # track last known order statuses for proactive notifications
+# last known status of orders still in progress, for proactive notifications; orders are dropped
+# once they reach a terminal status, so this only grows with the number of open orders
+last_order_status = {}
+TERMINAL_STATUSES = {"delivered"}
 
 # Files + locks
 PRODUCTS_CSV = "products.csv"
@@ -37,140 +54,392 @@ OFFERS_FILE = "offers.csv"
 CHECK_UPDATES_INTERVAL = 30   # how often to check for status changes and notify
 SIMULATOR_INTERVAL = 300      # 5 minutes (Processing -> Shipped -> Delivered)
 
+# Shared HTTP session for the Graph API: keeps TLS connections alive.
+# POSTs are only retried when they cannot have been processed (connect errors, 503); never on
+# read errors or other 5xx, which could duplicate a message/upload. 429 is left to the token bucket.
+HTTP_TIMEOUT = (5, 15)   # (connect, read) seconds for every Graph API call
+_session = requests.Session()
+_session.headers.update({"Authorization": f"Bearer {WHATSAPP_TOKEN}"})
+_session.mount("https://", HTTPAdapter(
+    pool_connections=10, pool_maxsize=20,
+    max_retries=Retry(total=3, connect=3, read=0, other=0, backoff_factor=0.2, status_forcelist=[503],
+                      allowed_methods=None, raise_on_status=False)))
+
+# Worker threads for fan-out notifications (each send is a blocking HTTP round-trip)
+SEND_WORKERS = 8
+_send_pool = ThreadPoolExecutor(max_workers=SEND_WORKERS, thread_name_prefix="send")
+
+# Pending (to, message) sends, fed to _send_pool by one worker thread whenever a send slot is free.
+# Each send holds its own slot, so one slow request doesn't hold up the rest of the queue.
+_send_q = queue.Queue()
+_send_slots = threading.BoundedSemaphore(SEND_WORKERS)
+_send_worker_lock = threading.Lock()
+_send_worker = None
+
+# Token bucket for outbound messages so we stay under the Cloud API throughput limit
+RATE_MPS = 50
+RATE_LIMIT_ERROR_CODE = 131056   # Graph API "pair rate limit hit"
+_bucket_lock = threading.Lock()
+_tokens = RATE_MPS
+_last_refill = time.monotonic()
+_paused_until = 0.0
+
+# Set to stop the background job threads
+_stop_event = threading.Event()
+
+# Placeholder cost model for P&L: cost is this fraction of revenue
+COST_RATIO = 0.7
+
 # Low stock threshold (< 10 triggers alert)
 LOW_STOCK_THRESHOLD = 10
 
+# In-memory copies of the CSVs; writes are coalesced and flushed after FLUSH_DELAY seconds.
+# The full rewrites replace whatever is on disk, so this process must be the only writer of
+# orders.csv/products.csv (the FileLock no longer protects a second process's changes).
+FLUSH_DELAY = 0.5
+_cache_lock = threading.RLock()
+_orders = None           # order_id -> row dict, in file order
+_orders_columns = None   # column order of orders.csv (used for appends)
+_next_order_id = None    # recovered from the highest numeric order_id on load
+_products_cache = None   # products DataFrame indexed by name
+_product_names_set = set()
+_product_lists = None    # rendered product/stock lists, rebuilt after products change
+_dirty = set()           # which caches ("orders", "products") need a full rewrite
+_flush_timer = None
+
+# Running sales totals (product -> {"qty", "revenue"}), kept up to date by add_order
+_sales_agg = {}
+_sales_agg_today = {}
+_sales_agg_date = None   # date _sales_agg_today belongs to; reset lazily when the day changes
+
+# Sales chart is only re-rendered after new sales; uploaded media ids are reused until they expire
+SALES_CHART_FILENAME = "sales.png"   # upload name for in-memory charts
+MEDIA_ID_TTL = 29 * 24 * 3600   # WhatsApp keeps uploaded media for 30 days
+_sales_version = 0           # bumped on every recorded sale
+_sales_chart_version = None  # _sales_version the cached chart was rendered from
+_sales_chart_png = None      # cached chart PNG bytes
+_chart_lock = threading.Lock()   # serializes chart checks/renders so a half-rendered chart is never returned
+_media_cache = {}        # sha1 of file content -> (media_id, uploaded_at)
+
+# Offers kept in memory; OFFERS_FILE is only appended to (add) or atomically rewritten (remove)
+_offers = None
+_offers_text = None      # rendered offers message, cleared when offers change
+
 
 # ---------- CSV helpers ----------
+def write_csv_atomic(df, path, lock=None):
+    """
+    Write df to a temp sibling, then os.replace it over path so readers never see a partial file.
+    If lock is given, only the swap is done while holding it.
+    """
+    tmp = path + ".tmp"
+    df.to_csv(tmp, index=False)
+    if lock is None:
+        os.replace(tmp, path)
+    else:
+        with lock:
+            os.replace(tmp, path)
+
+
 def load_products():
     # Ensure products CSV has name, price, stock
     if not os.path.exists(PRODUCTS_CSV):
         df = pd.DataFrame([["sugar", 40, 10], ["rice", 55, 10], ["oil", 120, 10]], columns=["name", "price", "stock"])
-        df.to_csv(PRODUCTS_CSV, index=False)
+        save_products(df)
     df = pd.read_csv(PRODUCTS_CSV)
     # If older file missing stock column, add it with default 10
     if "stock" not in df.columns:
         df["stock"] = 10
-        df.to_csv(PRODUCTS_CSV, index=False)
+        save_products(df)
     return df
 
 
 def load_orders():
     """
-    Load orders with FileLock, force strings to avoid .0 floats, and fill defaults.
+    Load orders, force strings to avoid .0 floats, and fill defaults.
     Ensures 'date' column exists (ISO yyyy-mm-dd).
+    No lock is needed to read: writers replace the file atomically.
     """
-    with FileLock(ORDERS_LOCK):
-        if not os.path.exists(ORDERS_CSV):
-            df = pd.DataFrame(columns=["order_id", "product", "quantity", "status", "eta", "payment", "customer", "date"])
-            df.to_csv(ORDERS_CSV, index=False)
-        else:
-            # Read everything as string to avoid numeric conversions that cause .0
-            df = pd.read_csv(ORDERS_CSV, dtype=str)
-            # Ensure required columns exist
-            if "payment" not in df.columns:
-                df["payment"] = "Cash/UPI on Delivery"
-            if "customer" not in df.columns:
-                df["customer"] = ""
-            if "eta" not in df.columns:
-                df["eta"] = "2 days"
-            if "date" not in df.columns:
-                df["date"] = datetime.date.today().isoformat()
-            # Replace NaN (if any) with defaults
-            df = df.fillna({
-                "payment": "Cash/UPI on Delivery",
-                "customer": "",
-                "eta": "2 days",
-                "quantity": "0",
-                "product": "",
-                "date": datetime.date.today().isoformat()
-            })
-            # Persist if we modified structure
-            df.to_csv(ORDERS_CSV, index=False)
+    if not os.path.exists(ORDERS_CSV):
+        df = pd.DataFrame(columns=["order_id", "product", "quantity", "status", "eta", "payment", "customer", "date"])
+        save_orders(df)
+    else:
+        # Read everything as string to avoid numeric conversions that cause .0
+        df = pd.read_csv(ORDERS_CSV, dtype=str)
+        # Ensure required columns exist
+        changed = False
+        if "payment" not in df.columns:
+            df["payment"] = "Cash/UPI on Delivery"
+            changed = True
+        if "customer" not in df.columns:
+            df["customer"] = ""
+            changed = True
+        if "eta" not in df.columns:
+            df["eta"] = "2 days"
+            changed = True
+        if "date" not in df.columns:
+            df["date"] = datetime.date.today().isoformat()
+            changed = True
+        # Replace NaN (if any) with defaults
+        df = df.fillna({
+            "payment": "Cash/UPI on Delivery",
+            "customer": "",
+            "eta": "2 days",
+            "quantity": "0",
+            "product": "",
+            "date": datetime.date.today().isoformat()
+        })
+        # Persist only if we modified structure (missing values are filled in memory only)
+        if changed:
+            save_orders(df)
     return df
 
 
 def save_orders(df):
-    with FileLock(ORDERS_LOCK):
-        df.to_csv(ORDERS_CSV, index=False)
+    # the swap shares the lock with single-row appends
+    write_csv_atomic(df, ORDERS_CSV, lock=FileLock(ORDERS_LOCK))
 
 
 def save_products(df):
-    # simple wrapper to persist products
-    df.to_csv(PRODUCTS_CSV, index=False)
+    # simple wrapper to persist products (the cached copy is indexed by name)
+    if df.index.name == "name":
+        df = df.reset_index()
+    write_csv_atomic(df, PRODUCTS_CSV)
+
+
+# ---------- In-memory cache ----------
+def get_products():
+    """Cached products DataFrame indexed by name (loaded from disk on first use). Mutate under _cache_lock."""
+    global _products_cache, _product_names_set
+    with _cache_lock:
+        if _products_cache is None:
+            _products_cache = load_products().set_index("name")
+            _product_names_set = set(_products_cache.index)
+        return _products_cache
+
+
+def get_product_lists():
+    """Rendered product lists ("customer", "admin", "stock"); re-rendered only after products change."""
+    global _product_lists
+    with _cache_lock:
+        if _product_lists is None:
+            df = get_products()
+            names = [n.capitalize() for n in df.index]
+            _product_lists = {
+                "customer": "\n".join(f"- {n} ₹{p}" for n, p in zip(names, df["price"])),
+                "admin": "\n".join(f"- {n} ₹{p} (stock: {st})" for n, p, st in zip(names, df["price"], df["stock"])),
+                "stock": "\n".join(f"- {n}: {int(st)} left" for n, st in zip(names, df["stock"])),
+            }
+        return _product_lists
+
+
+def products_changed():
+    """Call after mutating the cached products so the rendered lists are rebuilt."""
+    global _product_lists
+    with _cache_lock:
+        _product_lists = None
+
+
+def get_orders():
+    """Cached orders as a dict keyed by order_id (loaded from disk on first use). Mutate under _cache_lock."""
+    global _orders, _orders_columns, _next_order_id
+    with _cache_lock:
+        if _orders is None:
+            df = load_orders()
+            _orders_columns = list(df.columns)
+            _orders = {str(r["order_id"]): r for r in df.fillna("").to_dict("records")}
+            _next_order_id = max((int(oid) for oid in _orders if oid.isdigit()), default=10000) + 1
+            for r in _orders.values():
+                record_sale(r["product"], r["quantity"], r["date"])
+        return _orders
+
+
+def orders_frame():
+    """Build a DataFrame snapshot of the cached orders (for reports/charts only)."""
+    with _cache_lock:
+        orders = get_orders()
+        return pd.DataFrame.from_records(list(orders.values()), columns=_orders_columns)
+
+
+def append_order(row):
+    """Append a single order row to orders.csv without rewriting the file."""
+    with _cache_lock:
+        get_orders()
+        with FileLock(ORDERS_LOCK):
+            with open(ORDERS_CSV, "a", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=_orders_columns, restval="", extrasaction="ignore",
+                                        lineterminator="\n")
+                writer.writerow(row)
+        _orders[row["order_id"]] = row
+
+
+def _sales_today():
+    """Today's sales totals, emptied once the date rolls over."""
+    global _sales_agg_today, _sales_agg_date
+    today = datetime.date.today().isoformat()
+    if _sales_agg_date != today:
+        _sales_agg_today = {}
+        _sales_agg_date = today
+    return _sales_agg_today
+
+
+def record_sale(product, qty, date):
+    """
+    Add an order's quantity and revenue to the running sales totals.
+    Orders don't store a price, so revenue uses the product's current price (as the old
+    orders/products merge did); historical totals are rebuilt at startup with today's prices.
+    """
+    global _sales_version
+    try:
+        qty = float(qty)
+    except (TypeError, ValueError):
+        qty = 0
+    with _cache_lock:
+        products = get_products()
+        price = float(products.at[product, "price"]) if product in _product_names_set else 0
+        revenue = qty * price
+        targets = [_sales_agg]
+        if date == datetime.date.today().isoformat():
+            targets.append(_sales_today())
+        for agg in targets:
+            totals = agg.setdefault(product, {"qty": 0, "revenue": 0})
+            totals["qty"] += qty
+            totals["revenue"] += revenue
+        _sales_version += 1
+
+
+def _flush():
+    """Persist the dirty caches to disk."""
+    global _flush_timer
+    with _cache_lock:
+        _flush_timer = None
+        if "products" in _dirty and _products_cache is not None:
+            save_products(_products_cache)
+        if "orders" in _dirty and _orders is not None:
+            save_orders(orders_frame())
+        _dirty.clear()
+
+
+def schedule_flush(kind):
+    """Mark a cache ("orders"/"products") dirty and schedule a write; calls within FLUSH_DELAY share a single write."""
+    global _flush_timer
+    with _cache_lock:
+        _dirty.add(kind)
+        if _flush_timer is None:
+            _flush_timer = threading.Timer(FLUSH_DELAY, _flush)
+            _flush_timer.daemon = True
+            _flush_timer.start()
 
 
 def add_order(product, qty, customer):
     """
-    Add an order to orders.csv and return new order id.
+    Add an order (appended to orders.csv right away) and return new order id.
     customer should be the WhatsApp number string (e.g. '9198....')
     Also reduces stock permanently (until restocked). If insufficient stock, returns None.
     """
-    # Load and check stock first
-    products_df = load_products()
-    # Strict matching: product name must match exactly as present in CSV
-    if product not in products_df["name"].values:
-        # product doesn't exist
-        return None
-
+    global _next_order_id
     # Ensure qty int
     try:
         qty_int = int(qty)
     except Exception:
         return None
 
-    current_stock = int(products_df.loc[products_df["name"] == product, "stock"].values[0])
-    if qty_int > current_stock:
-        # insufficient stock
-        return None
+    with _cache_lock:
+        products_df = get_products()
+        # Strict matching: product name must match exactly as present in CSV
+        if product not in _product_names_set:
+            # product doesn't exist
+            return None
+
+        current_stock = int(products_df.at[product, "stock"])
+        if qty_int > current_stock:
+            # insufficient stock
+            return None
 
-    # reduce stock
-    products_df.loc[products_df["name"] == product, "stock"] = current_stock - qty_int
-    save_products(products_df)
+        # Now create order record
+        get_orders()
+        new_id = _next_order_id
+        new_row = {
+            "order_id": str(new_id),
+            "product": str(product),
+            "quantity": str(qty_int),
+            "status": "Processing",
+            "eta": "2 days",
+            "payment": "Cash/UPI on Delivery",
+            "customer": str(customer),
+            "date": datetime.date.today().isoformat()
+        }
+        append_order(new_row)
+        _next_order_id += 1
+
+        # reduce stock only once the order is on disk, and persist it in the same step
+        new_stock = current_stock - qty_int
+        products_df.at[product, "stock"] = new_stock
+        save_products(products_df)
+        products_changed()
+        record_sale(product, qty_int, new_row["date"])
 
     # low stock alert
-    new_stock = current_stock - qty_int
     if new_stock < LOW_STOCK_THRESHOLD:
-        for admin_num in admin_numbers:
+        for admin_num in list(admin_numbers):
             try:
-                send_whatsapp_message(admin_num,
-                                      f"⚠️ {product.capitalize()} only {new_stock} left, reorder soon!")
+                send_whatsapp_message_async(admin_num,
+                                            f"⚠️ {product.capitalize()} only {new_stock} left, reorder soon!")
             except Exception as e:
                 print("Failed sending low stock alert:", e)
 
-    # Now create order record
-    df = load_orders()
-    if df.empty:
-        new_id = 10001
-    else:
-        try:
-            max_id = int(df["order_id"].astype(int).max())
-            new_id = max_id + 1
-        except Exception:
-            new_id = df.shape[0] + 10001
-    new_row = {
-        "order_id": str(new_id),
-        "product": str(product),
-        "quantity": str(qty_int),
-        "status": "Processing",
-        "eta": "2 days",
-        "payment": "Cash/UPI on Delivery",
-        "customer": str(customer),
-        "date": datetime.date.today().isoformat()
-    }
-    df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-    save_orders(df)
     return str(new_id)
 
 
 # ---------- Messaging helpers ----------
+def _acquire_token():
+    """Block until the token bucket allows another message (RATE_MPS per second)."""
+    global _tokens, _last_refill
+    while True:
+        with _bucket_lock:
+            now = time.monotonic()
+            if now < _paused_until:
+                delay = _paused_until - now
+            else:
+                _tokens = min(RATE_MPS, _tokens + (now - _last_refill) * RATE_MPS)
+                _last_refill = now
+                if _tokens >= 1:
+                    _tokens -= 1
+                    return
+                delay = (1 - _tokens) / RATE_MPS
+        time.sleep(delay)
+
+
+def _check_rate_limit(r):
+    """If the API says we are rate limited, hold all sends for its Retry-After (default 1s)."""
+    global _tokens, _last_refill, _paused_until
+    limited = r.status_code == 429
+    if not limited:
+        try:
+            limited = r.json().get("error", {}).get("code") == RATE_LIMIT_ERROR_CODE
+        except Exception:
+            pass
+    if not limited:
+        return
+    try:
+        delay = float(r.headers.get("Retry-After", 1))
+    except ValueError:
+        delay = 1.0
+    with _bucket_lock:
+        _paused_until = max(_paused_until, time.monotonic() + delay)
+        _tokens = 0
+        _last_refill = _paused_until
+    print(f"Rate limited by WhatsApp API, pausing sends for {delay}s")
+
+
 def send_whatsapp_message(to, message):
     to = str(to)
     url = f"https://graph.facebook.com/v18.0/{PHONE_NUMBER_ID}/messages"
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}", "Content-Type": "application/json"}
     payload = {"messaging_product": "whatsapp", "to": to, "type": "text", "text": {"body": message}}
     try:
-        r = requests.post(url, headers=headers, json=payload)
+        _acquire_token()
+        r = _session.post(url, json=payload, timeout=HTTP_TIMEOUT)
+        _check_rate_limit(r)
         print("Text response:", r.status_code, r.text)
         return r.json()
     except Exception as e:
@@ -178,23 +447,60 @@ def send_whatsapp_message(to, message):
         return {}
 
 
-def upload_media(file_path):
+def _drain_send_queue():
+    """Worker loop: hand each queued message to _send_pool as soon as a send slot frees up."""
+    while True:
+        to, message = _send_q.get()
+        _send_slots.acquire()
+        try:
+            future = _send_pool.submit(send_whatsapp_message, to, message)
+        except Exception as e:
+            _send_slots.release()
+            print("Failed queueing message:", e)
+            continue
+        future.add_done_callback(lambda _: _send_slots.release())
+
+
+def send_whatsapp_message_async(to, message):
+    """Queue a text message for the background sender and return immediately."""
+    global _send_worker
+    with _send_worker_lock:
+        if _send_worker is None:
+            _send_worker = threading.Thread(target=_drain_send_queue, name="send-queue", daemon=True)
+            _send_worker.start()
+    _send_q.put((str(to), message))
+
+
+def upload_media(file_or_buf, filename=SALES_CHART_FILENAME):
     """
-    Upload file to /media and return media_id.
+    Upload a PNG (file path or file-like object) to /media and return media_id.
+    Re-uses the id from an earlier upload of the same content.
     """
-    abs_path = os.path.abspath(file_path)
+    if isinstance(file_or_buf, (str, os.PathLike)):
+        filename = os.path.basename(file_or_buf)
+        with open(file_or_buf, "rb") as f:
+            content = f.read()
+    else:
+        content = file_or_buf.read()
+    cache_key = hashlib.sha1(content).hexdigest()
+    cached = _media_cache.get(cache_key)
+    if cached and time.time() - cached[1] < MEDIA_ID_TTL:
+        return cached[0]
     url = f"https://graph.facebook.com/v18.0/{PHONE_NUMBER_ID}/media"
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}"}
     # Force image MIME type so API accepts it
-    files = {"file": (os.path.basename(abs_path), open(abs_path, "rb"), "image/png")}
+    files = {"file": (filename, content, "image/png")}
     data = {"messaging_product": "whatsapp"}
-    r = requests.post(url, headers=headers, files=files, data=data)
+    r = _session.post(url, files=files, data=data, timeout=HTTP_TIMEOUT)
     print("Upload response:", r.status_code, r.text)
     # Return id if present
     try:
-        return r.json().get("id")
+        media_id = r.json().get("id")
     except Exception:
         return None
+    if media_id:
+        _media_cache.clear()   # older chart versions are stale
+        _media_cache[cache_key] = (media_id, time.time())
+    return media_id
 
 
 def send_image_by_media_id(to, media_id, caption=""):
@@ -203,23 +509,24 @@ def send_image_by_media_id(to, media_id, caption=""):
     """
     to = str(to)
     url = f"https://graph.facebook.com/v18.0/{PHONE_NUMBER_ID}/messages"
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}", "Content-Type": "application/json"}
     payload = {
         "messaging_product": "whatsapp",
         "to": to,
         "type": "image",
         "image": {"id": media_id, "caption": caption}
     }
-    r = requests.post(url, headers=headers, json=payload)
+    _acquire_token()
+    r = _session.post(url, json=payload, timeout=HTTP_TIMEOUT)
+    _check_rate_limit(r)
     print("Send image response:", r.status_code, r.text)
     return r.json()
 
 
-def send_image(to, file_path, caption=""):
+def send_image(to, file_or_buf, caption=""):
     """
     Convenience: upload then send. If upload fails, notify user.
     """
-    media_id = upload_media(file_path)
+    media_id = upload_media(file_or_buf)
     if not media_id:
         send_whatsapp_message(to, "⚠️ Failed to upload image.")
         return None
@@ -229,28 +536,33 @@ def send_image(to, file_path, caption=""):
 # ---------- Chart helpers ----------
 def generate_sales_chart():
     """
-    Generate a sales chart (quantity sold per product) from orders.csv.
-    Returns path to saved chart or None.
+    Generate a sales chart (quantity sold per product) from the running sales totals.
+    Returns the PNG as an in-memory BytesIO, or None. The rendered chart is reused until a new sale is recorded.
     """
+    global _sales_chart_version, _sales_chart_png
     try:
-        df = load_orders()
-        if df.empty:
-            return None
-        # Ensure quantity numeric
-        df["quantity"] = pd.to_numeric(df["quantity"], errors="coerce").fillna(0)
-        sales = df.groupby("product", as_index=False)["quantity"].sum()
-        if sales.empty:
-            return None
-        plt.figure(figsize=(6, 4))
-        plt.bar(sales["product"], sales["quantity"])
-        plt.xlabel("Product")
-        plt.ylabel("Quantity Sold")
-        plt.title("Sales Insights (All-time)")
-        plt.tight_layout()
-        chart_path = "sales.png"
-        plt.savefig(chart_path)
-        plt.close()
-        return chart_path
+        with _chart_lock:
+            with _cache_lock:
+                get_orders()
+                version = _sales_version
+                if version == _sales_chart_version and _sales_chart_png is not None:
+                    return io.BytesIO(_sales_chart_png)
+                sales = sorted((p, v["qty"]) for p, v in _sales_agg.items())
+            if not sales:
+                return None
+            plt.figure(figsize=(6, 4))
+            plt.bar([p for p, _ in sales], [q for _, q in sales])
+            plt.xlabel("Product")
+            plt.ylabel("Quantity Sold")
+            plt.title("Sales Insights (All-time)")
+            plt.tight_layout()
+            buf = io.BytesIO()
+            plt.savefig(buf, format="png")
+            plt.close()
+            # only mark the chart current once it is fully rendered
+            _sales_chart_png = buf.getvalue()
+            _sales_chart_version = version
+            return io.BytesIO(_sales_chart_png)
     except Exception as e:
         print("generate_sales_chart error:", e)
         return None
@@ -263,25 +575,16 @@ def generate_pnl_summary():
     We assume cost = 70% of price (as placeholder) unless you provide exact cost column.
     """
     try:
-        df = load_orders()
-        if df.empty:
-            return "📊 No sales yet."
-        today = datetime.date.today().isoformat()
-        today_orders = df[df["date"] == today]
-        if today_orders.empty:
+        with _cache_lock:
+            if not get_orders():
+                return "📊 No sales yet."
+            today_sales = list(_sales_today().values())
+        if not today_sales:
             return "📊 No sales today."
-        products = load_products()
-        # merge on product name
-        merged = today_orders.merge(products, left_on="product", right_on="name", how="left")
-        merged["quantity"] = pd.to_numeric(merged["quantity"], errors="coerce").fillna(0)
-        merged["price"] = pd.to_numeric(merged["price"], errors="coerce").fillna(0)
-        # assume cost is 70% of price
-        merged["revenue"] = merged["quantity"] * merged["price"]
-        merged["cost"] = merged["quantity"] * (merged["price"] * 0.7)
-        merged["profit"] = merged["revenue"] - merged["cost"]
-        total_rev = merged["revenue"].sum()
-        total_cost = merged["cost"].sum()
-        total_profit = merged["profit"].sum()
+        # cost is a flat fraction of price, so cost and profit follow from the revenue total
+        total_rev = sum(v["revenue"] for v in today_sales)
+        total_cost = total_rev * COST_RATIO
+        total_profit = total_rev - total_cost
         return (f"💰 Today's Summary:\n"
                 f"Revenue: ₹{total_rev:.2f}\n"
                 f"Cost: ₹{total_cost:.2f}\n"
@@ -296,15 +599,13 @@ def generate_demand_insights_text():
     All-time demand insights (text).
     """
     try:
-        orders = load_orders()
-        if orders.empty:
-            return "📊 No demand data yet."
-        orders["quantity"] = pd.to_numeric(orders["quantity"], errors="coerce").fillna(0)
-        demand = orders.groupby("product")["quantity"].sum().sort_values(ascending=False)
-        if demand.empty:
+        with _cache_lock:
+            get_orders()
+            demand = sorted(_sales_agg, key=lambda p: _sales_agg[p]["qty"], reverse=True)
+        if not demand:
             return "📊 No demand data yet."
-        top = demand.index[0]
-        bottom = demand.index[-1]
+        top = demand[0]
+        bottom = demand[-1]
         return f"🔥 In-demand: {top}\n❄️ Not in demand: {bottom}"
     except Exception as e:
         print("Demand error:", e)
@@ -312,47 +613,96 @@ def generate_demand_insights_text():
 
 
 # ---------- Offers helpers ----------
+def get_offers():
+    """Cached offers list (read from OFFERS_FILE on first use). Mutate under _cache_lock."""
+    global _offers
+    with _cache_lock:
+        if _offers is None:
+            _offers = []
+            if os.path.exists(OFFERS_FILE):
+                with open(OFFERS_FILE, "r") as f:
+                    _offers = [o for o in (line.strip() for line in f) if o]
+        return _offers
+
+
 def get_offers_text():
-    if os.path.exists(OFFERS_FILE):
-        with open(OFFERS_FILE, "r") as f:
-            offers = [o for o in (line.strip() for line in f.readlines()) if o]
-        if offers:
-            return "🎉 Today's Offers:\n- " + "\n- ".join(offers)
-    # fallback default offers (if file missing or empty)
-    return ("🎉 Today's Offers:\n- 10% off on Rice\n- Buy 1 Get 1 Free on Sugar\n- Flat ₹20 off on Oil")
+    global _offers_text
+    with _cache_lock:
+        if _offers_text is None:
+            offers = get_offers()
+            if offers:
+                _offers_text = "🎉 Today's Offers:\n- " + "\n- ".join(offers)
+            else:
+                # fallback default offers (if file missing or empty)
+                _offers_text = "🎉 Today's Offers:\n- 10% off on Rice\n- Buy 1 Get 1 Free on Sugar\n- Flat ₹20 off on Oil"
+        return _offers_text
+
+
+def add_offer(offer):
+    """Append an offer to OFFERS_FILE and the cached list."""
+    global _offers_text
+    with _cache_lock:
+        offers = get_offers()
+        with open(OFFERS_FILE, "a") as f:
+            f.write(offer + "\n")
+        offers.append(offer)
+        _offers_text = None
+
+
+def remove_offer(offer):
+    """Remove the first matching offer, rewriting OFFERS_FILE atomically. Returns False if not found."""
+    global _offers, _offers_text
+    with _cache_lock:
+        remaining = list(get_offers())
+        if offer not in remaining:
+            return False
+        remaining.remove(offer)
+        tmp = OFFERS_FILE + ".tmp"
+        with open(tmp, "w") as f:
+            f.writelines(o + "\n" for o in remaining)
+        os.replace(tmp, OFFERS_FILE)
+        _offers = remaining
+        _offers_text = None
+        return True
 
 
 # ---------- Proactive updates ----------
 def check_order_updates():
     """
-    Check orders.csv for status changes and notify respective customers.
-    Runs periodically in its own Timer thread.
+    Check the cached orders for status changes and notify respective customers.
+    Runs every CHECK_UPDATES_INTERVAL seconds on its background thread.
     """
-    global last_order_status
     try:
-        df = load_orders()
-        for _, row in df.iterrows():
-            oid = str(row["order_id"])
-            current_status = str(row.get("status", "")).strip()
-            if oid not in last_order_status:
-                last_order_status[oid] = current_status
-                continue
-            if last_order_status[oid] != current_status:
-                last_order_status[oid] = current_status
-                customer = str(row.get("customer", "")).strip()
-                # don't attempt to send if customer missing
-                if customer:
-                    send_whatsapp_message(
-                        customer,
-                        f"📦 Order Update!\n"
-                        f"Your Order #{row['order_id']} ({row['product']} x{row['quantity']}) is now {row['status']} 🚚\n"
-                        f"📅 Estimated Delivery Time: {row.get('eta', '2 days')}\n"
-                        f"💰 Payment Mode: {row.get('payment', 'Cash/UPI on Delivery')}"
-                    )
+        changed = []
+        with _cache_lock, _state_lock:
+            for oid, r in get_orders().items():
+                status = str(r.get("status", "")).strip()
+                previous = last_order_status.get(oid)
+                if status.lower() in TERMINAL_STATUSES:
+                    # finished orders are notified once (if we were tracking them), then forgotten
+                    if previous is None:
+                        continue
+                    del last_order_status[oid]
+                else:
+                    last_order_status[oid] = status
+                    if previous is None:
+                        # orders seen for the first time are only recorded, not notified
+                        continue
+                if previous != status:
+                    changed.append(dict(r))
+        for row in changed:
+            customer = str(row.get("customer", "")).strip()
+            # don't attempt to send if customer missing
+            if customer:
+                send_whatsapp_message_async(
+                    customer,
+                    f"📦 Order Update!\n"
+                    f"Your Order #{row['order_id']} ({row['product']} x{row['quantity']}) is now {row['status']} 🚚\n"
+                    f"📅 Estimated Delivery Time: {row.get('eta', '2 days')}\n"
+                    f"💰 Payment Mode: {row.get('payment', 'Cash/UPI on Delivery')}"
+                )
     except Exception as e:
         print("Error checking updates:", e)
-    # schedule next run
-    threading.Timer(CHECK_UPDATES_INTERVAL, check_order_updates).start()
 
 
 # ---------- Simulator ----------
@@ -364,35 +714,51 @@ def simulate_order_flow():
     Runs every SIMULATOR_INTERVAL seconds (5 minutes as requested).
     """
     try:
-        df = load_orders()
-        if df.empty:
-            pass
-        else:
-            updated = False
-            for idx, row in df.iterrows():
-                status = str(row.get("status", "")).strip()
-                if status.lower() == "processing":
-                    df.at[idx, "status"] = "Shipped"
-                    df.at[idx, "eta"] = "Tomorrow"
-                    save_orders(df)
-                    print(f"Simulated: Order {row['order_id']} -> Shipped")
-                    updated = True
-                    break
-                elif status.lower() == "shipped":
-                    df.at[idx, "status"] = "Delivered"
-                    df.at[idx, "eta"] = "Delivered Today"
-                    save_orders(df)
-                    print(f"Simulated: Order {row['order_id']} -> Delivered")
-                    updated = True
-                    break
-            if not updated:
-                # nothing to simulate this round
+        with _cache_lock:
+            orders = get_orders()
+            if not orders:
                 pass
+            else:
+                updated = False
+                for row in orders.values():
+                    status = str(row.get("status", "")).strip()
+                    if status.lower() == "processing":
+                        row["status"] = "Shipped"
+                        row["eta"] = "Tomorrow"
+                        schedule_flush("orders")
+                        print(f"Simulated: Order {row['order_id']} -> Shipped")
+                        updated = True
+                        break
+                    elif status.lower() == "shipped":
+                        row["status"] = "Delivered"
+                        row["eta"] = "Delivered Today"
+                        schedule_flush("orders")
+                        print(f"Simulated: Order {row['order_id']} -> Delivered")
+                        updated = True
+                        break
+                if not updated:
+                    # nothing to simulate this round
+                    pass
     except Exception as e:
         print("Error simulating orders:", e)
 
-    # schedule next run (5 minutes)
-    threading.Timer(SIMULATOR_INTERVAL, simulate_order_flow).start()
+
+# ---------- Background jobs ----------
+def run_periodically(job, interval):
+    """Run job every interval seconds until _stop_event is set."""
+    while not _stop_event.is_set():
+        try:
+            job()
+        except Exception as e:
+            print(f"Error in {job.__name__}:", e)
+        _stop_event.wait(interval)
+
+
+def start_background_jobs():
+    """Start one long-lived daemon thread per periodic job."""
+    for job, interval in ((check_order_updates, CHECK_UPDATES_INTERVAL),
+                          (simulate_order_flow, SIMULATOR_INTERVAL)):
+        threading.Thread(target=run_periodically, args=(job, interval), name=job.__name__, daemon=True).start()
 
 
 # ---------- Simple Menus ----------
@@ -436,12 +802,16 @@ def handle_admin_command_text(from_number, text):
         except Exception:
             send_whatsapp_message(from_number, "⚠️ Quantity must be an integer.")
             return True
-        products = load_products()
-        # strict name match
-        if item in products["name"].values:
-            products.loc[products["name"] == item, "stock"] = products.loc[products["name"] == item, "stock"].astype(int) + qty
-            save_products(products)
-            new_stock = int(products.loc[products["name"] == item, "stock"].values[0])
+        with _cache_lock:
+            products = get_products()
+            # strict name match
+            found = item in _product_names_set
+            if found:
+                new_stock = int(products.at[item, "stock"]) + qty
+                products.at[item, "stock"] = new_stock
+                products_changed()
+                schedule_flush("products")
+        if found:
             send_whatsapp_message(from_number, f"✅ Restocked {item} by {qty}. New stock: {new_stock}")
         else:
             send_whatsapp_message(from_number, f"⚠️ Product '{item}' not found.")
@@ -452,10 +822,8 @@ def handle_admin_command_text(from_number, text):
         if not offer:
             send_whatsapp_message(from_number, "⚠️ Usage: add offer <offer text>")
             return True
-        # append to offers file
         try:
-            with open(OFFERS_FILE, "a") as f:
-                f.write(offer + "\n")
+            add_offer(offer)
             send_whatsapp_message(from_number, f"✅ Offer '{offer}' added.")
         except Exception as e:
             send_whatsapp_message(from_number, f"⚠️ Could not add offer: {e}")
@@ -469,13 +837,7 @@ def handle_admin_command_text(from_number, text):
         if not os.path.exists(OFFERS_FILE):
             send_whatsapp_message(from_number, "⚠️ No offers file exists.")
             return True
-        with open(OFFERS_FILE, "r") as f:
-            offers = [line.strip() for line in f.readlines() if line.strip()]
-        if offer in offers:
-            offers.remove(offer)
-            with open(OFFERS_FILE, "w") as f:
-                for o in offers:
-                    f.write(o + "\n")
+        if remove_offer(offer):
             send_whatsapp_message(from_number, f"✅ Offer '{offer}' removed.")
         else:
             send_whatsapp_message(from_number, f"⚠️ Offer '{offer}' not found.")
@@ -488,6 +850,157 @@ def handle_admin_command_text(from_number, text):
     return False
 
 
+# ---------- Menu handlers ----------
+# Admin numeric options: 1 products, 2 orders, 3 sales chart, 4 P&L (today), 5 stock, 6 demand (all time)
+def _admin_products(from_number):
+    send_whatsapp_message(from_number, f"📦 Products:\n{get_product_lists()['admin']}")
+
+
+def _admin_orders(from_number):
+    with _cache_lock:
+        lines = [f"#{r['order_id']}: {r['product']} x{r['quantity']} - {r['status']}" for r in get_orders().values()]
+    if not lines:
+        send_whatsapp_message(from_number, "📭 No orders yet.")
+    else:
+        send_whatsapp_message(from_number, "📝 Orders:\n" + "\n".join(lines))
+
+
+def _admin_sales_chart(from_number):
+    chart = generate_sales_chart()
+    if chart:
+        send_image(from_number, chart, "📊 Sales Insights")
+    else:
+        send_whatsapp_message(from_number, "⚠️ No sales data yet.")
+
+
+def _admin_pnl(from_number):
+    send_whatsapp_message(from_number, generate_pnl_summary())
+
+
+def _admin_stock(from_number):
+    send_whatsapp_message(from_number, f"📦 Stock Levels:\n{get_product_lists()['stock']}")
+
+
+def _admin_demand(from_number):
+    # send text demand insights and also try to send chart
+    send_whatsapp_message(from_number, generate_demand_insights_text())
+    chart = generate_sales_chart()
+    if chart:
+        send_image(from_number, chart, "📊 All-time Demand Chart")
+
+
+def get_session(key):
+    with _state_lock:
+        return user_sessions.get(key)
+
+
+def set_session(key, state):
+    with _state_lock:
+        user_sessions[key] = state
+
+
+def pop_session(key):
+    with _state_lock:
+        return user_sessions.pop(key, None)
+
+
+def _cust_menu(from_number):
+    pop_session(from_number)
+    send_whatsapp_message(from_number, customer_menu_text())
+
+
+def _cust_products(from_number):
+    send_whatsapp_message(from_number, f"🛒 Products:\n{get_product_lists()['customer']}")
+
+
+def _cust_order_status(from_number):
+    set_session(from_number, "awaiting_order_id")
+    send_whatsapp_message(from_number, "📦 Please enter your Order ID:")
+
+
+def _cust_new_order(from_number):
+    set_session(from_number, "awaiting_new_order")
+    send_whatsapp_message(from_number, "📝 Type order as: product,quantity\nExample: rice,2")
+
+
+def _cust_offers(from_number):
+    # show dynamic offers from OFFERS_FILE if present
+    send_whatsapp_message(from_number, get_offers_text())
+
+
+def _cust_support(from_number):
+    send_whatsapp_message(from_number, "📞 Talk to Support: +91-9996033812")
+
+
+def _reply_order_id(from_number, text):
+    """Reply to the 'enter your Order ID' prompt."""
+    order_id = text
+    # strict order id check: digits only
+    if not order_id.isdigit():
+        send_whatsapp_message(from_number, "⚠️ Order ID should contain digits only.")
+        return
+    row = get_orders().get(order_id)
+    if row is not None:
+        send_whatsapp_message(from_number,
+            f"✅ Order #{row['order_id']} ({row['product']} x{row['quantity']}) is {row['status']} 🚚\n"
+            f"📅 Estimated Delivery Time: {row.get('eta','2 days')}\n"
+            f"💰 Payment Mode: {row.get('payment','Cash/UPI on Delivery')}"
+        )
+    else:
+        send_whatsapp_message(from_number, "⚠️ Order not found.")
+
+
+def _reply_new_order(from_number, text):
+    """Reply to the 'product,quantity' prompt."""
+    if "," not in text:
+        send_whatsapp_message(from_number, "⚠️ Wrong format. Send: product,quantity")
+        return
+    try:
+        product, qty = [t.strip() for t in text.split(",", 1)]
+        # strict: product must match exactly in products list (case-sensitive in CSV). We keep text lowercased as earlier.
+        new_id = add_order(product, int(qty), from_number)
+        if not new_id:
+            send_whatsapp_message(from_number, "⚠️ Could not place order. Product may not exist, format wrong, or insufficient stock.")
+        else:
+            send_whatsapp_message(from_number,
+                f"📝 Order placed: {qty} {product}\n"
+                f"Your Order ID: {new_id}\n"
+                f"📅 Estimated Delivery Time: 2 days\n"
+                f"💰 Payment Mode: Cash/UPI on Delivery")
+            send_whatsapp_message(from_number,
+                "🙏 Thank you for shopping with Dukaan-Dost!\nWe’ll notify you when your order is out for delivery. 🚚")
+    except Exception as e:
+        print("Error saving order:", e)
+        send_whatsapp_message(from_number, "⚠️ Could not save order. Try again.")
+
+
+_admin_handlers = {
+    "1": _admin_products,
+    "2": _admin_orders,
+    "3": _admin_sales_chart,
+    "4": _admin_pnl,
+    "5": _admin_stock,
+    "6": _admin_demand,
+}
+
+_customer_handlers = {
+    "hi": _cust_menu,
+    "hello": _cust_menu,
+    "hey": _cust_menu,
+    "1": _cust_products,
+    "2": _cust_order_status,
+    "3": _cust_new_order,
+    "4": _cust_offers,
+    "5": _cust_support,
+}
+
+# session state -> handler for the customer's reply
+_session_handlers = {
+    "awaiting_order_id": _reply_order_id,
+    "awaiting_new_order": _reply_new_order,
+}
+
+
 # ---------- Routes ----------
 @app.route("/webhook", methods=["GET"])
 def verify():
@@ -498,176 +1011,88 @@ def verify():
 
 @app.route("/webhook", methods=["POST"])
 def incoming():
-    data = request.get_json()
-    print("Webhook:", data)
-
-    if not (data and "entry" in data):
+    try:
+        data = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError:
         return "ok", 200
 
-    # Basic parsing of single-message events
-    for entry in data.get("entry", []):
-        for change in entry.get("changes", []):
-            value = change.get("value", {})
-            messages = value.get("messages", [])
-            for message in messages:
-                from_number = message.get("from")
-                session_key = from_number
-                # keep incoming normalized to lowercase as earlier code did (strict lower commands required)
-                text = message.get("text", {}).get("body", "").strip().lower()
-                print(f"[{from_number}] {text} (session={user_sessions.get(session_key)})")
-
-                # ---------- Admin login ----------
-                if text.startswith("admin"):
-                    parts = text.split()
-                    if len(parts) >= 2 and parts[1] == ADMIN_PIN:
-                        admin_numbers.add(from_number)
-                        send_whatsapp_message(from_number, "✅ Admin mode activated.\n\n" + admin_menu_text())
-                    else:
-                        send_whatsapp_message(from_number, "❌ Wrong admin PIN.")
-                    continue
-
-                if text == "exit" and from_number in admin_numbers:
-                    admin_numbers.discard(from_number)
-                    send_whatsapp_message(from_number, "👋 Exited admin mode.")
-                    continue
-
-                # ---------- Admin actions ----------
-                if from_number in admin_numbers:
-                    # first, check our admin textual commands (restock, add/remove offer, offers)
-                    handled = handle_admin_command_text(from_number, text)
-                    if handled:
-                        continue
-
-                    # keep your original admin numeric options (1/2/3) intact
-                    if text == "1":
-                        df = load_products()
-                        products = "\n".join([f"- {r['name'].capitalize()} ₹{r['price']} (stock: {r['stock']})" for _, r in df.iterrows()])
-                        send_whatsapp_message(from_number, f"📦 Products:\n{products}")
-                        continue
-                    if text == "2":
-                        df = load_orders()
-                        if df.empty:
-                            send_whatsapp_message(from_number, "📭 No orders yet.")
-                        else:
-                            lines = [f"#{r['order_id']}: {r['product']} x{r['quantity']} - {r['status']}" for _, r in df.iterrows()]
-                            send_whatsapp_message(from_number, "📝 Orders:\n" + "\n".join(lines))
-                        continue
-                    if text == "3":
-                        chart = generate_sales_chart()
-                        if chart:
-                            send_image(from_number, chart, "📊 Sales Insights")
-                        else:
-                            send_whatsapp_message(from_number, "⚠️ No sales data yet.")
-                        continue
+    if not isinstance(data, dict) or "entry" not in data:
+        return "ok", 200
 
-                    # New admin menu actions: 4 -> P&L (today), 5 -> Stock Levels, 6 -> Demand insights (all time)
-                    if text == "4":
-                        send_whatsapp_message(from_number, generate_pnl_summary())
-                        continue
-                    if text == "5":
-                        products = load_products()
-                        stock_list = "\n".join([f"- {r['name'].capitalize()}: {int(r['stock'])} left" for _, r in products.iterrows()])
-                        send_whatsapp_message(from_number, f"📦 Stock Levels:\n{stock_list}")
-                        continue
-                    if text == "6":
-                        # send text demand insights and also try to send chart
-                        send_whatsapp_message(from_number, generate_demand_insights_text())
-                        chart = generate_sales_chart()
-                        if chart:
-                            send_image(from_number, chart, "📊 All-time Demand Chart")
-                        continue
+    # Only single-message events are handled; status callbacks (delivery/read receipts) have no messages
+    try:
+        messages = data["entry"][0]["changes"][0]["value"]["messages"]
+    except (KeyError, IndexError, TypeError):
+        return "ok", 200
+    print("Webhook:", data)
 
-                    send_whatsapp_message(from_number, "⚠️ Invalid admin option. Use 1/2/3/4/5/6, 'offers', or admin commands, or 'exit'.")
-                    continue
-
-                # ---------- Customer flow ----------
-                # 1) Awaiting order ID input (after selecting option 2)
-                if user_sessions.get(session_key) == "awaiting_order_id":
-                    user_sessions.pop(session_key, None)
-                    order_id = text
-                    df = load_orders()
-                    # strict order id check: digits only
-                    if not order_id.isdigit():
-                        send_whatsapp_message(from_number, "⚠️ Order ID should contain digits only.")
-                        continue
-                    if order_id in df["order_id"].astype(str).values:
-                        row = df[df["order_id"].astype(str) == order_id].iloc[0]
-                        send_whatsapp_message(from_number,
-                            f"✅ Order #{row['order_id']} ({row['product']} x{row['quantity']}) is {row['status']} 🚚\n"
-                            f"📅 Estimated Delivery Time: {row.get('eta','2 days')}\n"
-                            f"💰 Payment Mode: {row.get('payment','Cash/UPI on Delivery')}"
-                        )
-                    else:
-                        send_whatsapp_message(from_number, "⚠️ Order not found.")
-                    continue
-
-                # 2) Awaiting new order (after selecting option 3)
-                if user_sessions.get(session_key) == "awaiting_new_order":
-                    user_sessions.pop(session_key, None)
-                    if "," in text:
-                        try:
-                            product, qty = [t.strip() for t in text.split(",", 1)]
-                            # strict: product must match exactly in products list (case-sensitive in CSV). We keep text lowercased as earlier.
-                            new_id = add_order(product, int(qty), from_number)
-                            if not new_id:
-                                send_whatsapp_message(from_number, "⚠️ Could not place order. Product may not exist, format wrong, or insufficient stock.")
-                            else:
-                                send_whatsapp_message(from_number,
-                                    f"📝 Order placed: {qty} {product}\n"
-                                    f"Your Order ID: {new_id}\n"
-                                    f"📅 Estimated Delivery Time: 2 days\n"
-                                    f"💰 Payment Mode: Cash/UPI on Delivery")
-                                send_whatsapp_message(from_number,
-                                    "🙏 Thank you for shopping with Dukaan-Dost!\nWe’ll notify you when your order is out for delivery. 🚚")
-                        except Exception as e:
-                            print("Error saving order:", e)
-                            send_whatsapp_message(from_number, "⚠️ Could not save order. Try again.")
-                    else:
-                        send_whatsapp_message(from_number, "⚠️ Wrong format. Send: product,quantity")
-                    continue
-
-                # 3) Menu / commands
-                if text in ["hi", "hello", "hey"]:
-                    user_sessions.pop(session_key, None)
-                    send_whatsapp_message(from_number, customer_menu_text())
-                    continue
-
-                if text == "1":
-                    df = load_products()
-                    products = "\n".join([f"- {r['name'].capitalize()} ₹{r['price']}" for _, r in df.iterrows()])
-                    send_whatsapp_message(from_number, f"🛒 Products:\n{products}")
-                    continue
-
-                if text == "2":
-                    user_sessions[session_key] = "awaiting_order_id"
-                    send_whatsapp_message(from_number, "📦 Please enter your Order ID:")
-                    continue
-
-                if text == "3":
-                    user_sessions[session_key] = "awaiting_new_order"
-                    send_whatsapp_message(from_number, "📝 Type order as: product,quantity\nExample: rice,2")
-                    continue
-
-                if text == "4":
-                    # show dynamic offers from OFFERS_FILE if present
-                    send_whatsapp_message(from_number, get_offers_text())
-                    continue
-
-                if text == "5":
-                    send_whatsapp_message(from_number, "📞 Talk to Support: +91-9996033812")
-                    continue
-
-                if text.isdigit():
-                    send_whatsapp_message(from_number, "⚠️ Invalid option. Reply with 1-5 or type 'hi' for menu.")
-                    continue
-
-                send_whatsapp_message(from_number, "⚠️ Invalid choice. Reply with 1-5 or 'hi' for menu.")
+    for message in messages:
+        from_number = message.get("from")
+        session_key = from_number
+        # keep incoming normalized to lowercase as earlier code did (strict lower commands required)
+        text = message.get("text", {}).get("body", "").strip().lower()
+        state = get_session(session_key)
+        print(f"[{from_number}] {text} (session={state})")
+
+        # ---------- Admin login ----------
+        if text.startswith("admin"):
+            parts = text.split()
+            if len(parts) >= 2 and parts[1] == ADMIN_PIN:
+                admin_numbers.add(from_number)
+                send_whatsapp_message(from_number, "✅ Admin mode activated.\n\n" + admin_menu_text())
+            else:
+                send_whatsapp_message(from_number, "❌ Wrong admin PIN.")
+            continue
+
+        if text == "exit" and from_number in admin_numbers:
+            admin_numbers.discard(from_number)
+            send_whatsapp_message(from_number, "👋 Exited admin mode.")
+            continue
+
+        # ---------- Admin actions ----------
+        if from_number in admin_numbers:
+            # first, check our admin textual commands (restock, add/remove offer, offers)
+            if handle_admin_command_text(from_number, text):
+                continue
+            handler = _admin_handlers.get(text)
+            if handler:
+                handler(from_number)
+            else:
+                send_whatsapp_message(from_number, "⚠️ Invalid admin option. Use 1/2/3/4/5/6, 'offers', or admin commands, or 'exit'.")
+            continue
+
+        # ---------- Customer flow ----------
+        # Replies to a previous prompt (order id after option 2, new order after option 3) come first
+        if state in _session_handlers:
+            pop_session(session_key)
+            _session_handlers[state](from_number, text)
+            continue
+
+        handler = _customer_handlers.get(text)
+        if handler:
+            handler(from_number)
+            continue
+
+        if text.isdigit():
+            send_whatsapp_message(from_number, "⚠️ Invalid option. Reply with 1-5 or type 'hi' for menu.")
+            continue
+
+        send_whatsapp_message(from_number, "⚠️ Invalid choice. Reply with 1-5 or 'hi' for menu.")
 
     return "ok", 200
 
 
 if __name__ == "__main__":
-    # start background jobs
-    check_order_updates()
-    simulate_order_flow()
+    # With debug=True the Werkzeug reloader runs this block in a watcher process and again in the
+    # serving child (WERKZEUG_RUN_MAIN=true). Only the child may own the caches and background jobs,
+    # otherwise the watcher's stale snapshot would overwrite orders appended by the child.
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        # load caches once up front and make sure pending writes land on shutdown
+        get_products()
+        get_orders()
+        get_offers()
+        atexit.register(_flush)
+        atexit.register(_stop_event.set)
+        # start background jobs
+        start_background_jobs()
     app.run(port=5000, debug=True)
@@ -0,0 +1,15 @@
+import importlib
+
+import pytest
+
+import app as app_module
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """Fresh app module working on CSVs in a temp directory."""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "products.csv").write_text("name,price,stock\nsugar,40,50\nrice,55,50\noil,120,50\n")
+    mod = importlib.reload(app_module)
+    monkeypatch.setattr(mod, "send_whatsapp_message", lambda to, message: {})
+    return mod
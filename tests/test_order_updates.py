@@ -0,0 +1,37 @@
+import pytest
+
+
+@pytest.fixture
+def sent(app, monkeypatch):
+    messages = []
+    monkeypatch.setattr(app, "send_whatsapp_message_async", lambda to, message: messages.append((to, message)))
+    return messages
+
+
+def test_status_changes_are_notified_until_delivered(app, sent):
+    oid = app.add_order("rice", 2, "91")
+    app.check_order_updates()
+    assert sent == []
+    assert app.last_order_status == {oid: "Processing"}
+
+    app.simulate_order_flow()
+    app.check_order_updates()
+    assert len(sent) == 1 and "is now Shipped" in sent[0][1]
+
+    app.simulate_order_flow()
+    app.check_order_updates()
+    assert len(sent) == 2 and "is now Delivered" in sent[1][1]
+    # delivered orders are no longer tracked, and not notified again
+    assert app.last_order_status == {}
+    app.check_order_updates()
+    assert len(sent) == 2
+
+
+def test_delivered_orders_are_never_tracked(app, sent):
+    app.add_order("oil", 1, "91")
+    app.add_order("sugar", 1, "91")
+    for _ in range(4):
+        app.simulate_order_flow()
+    app.check_order_updates()
+    assert sent == []
+    assert app.last_order_status == {}
@@ -0,0 +1,43 @@
+import importlib
+
+
+def test_reports_without_orders(app):
+    assert app.generate_pnl_summary() == "📊 No sales yet."
+    assert app.generate_demand_insights_text() == "📊 No demand data yet."
+
+
+def test_reports_follow_placed_orders(app):
+    assert app.add_order("rice", 2, "91")
+    assert app.add_order("sugar", 5, "91")
+    assert app.add_order("oil", 1, "91")
+    assert app.add_order("sugar", 1, "91")
+
+    # revenue = 2*55 + 6*40 + 1*120 = 470, cost is 70% of it
+    assert app.generate_pnl_summary() == ("💰 Today's Summary:\n"
+                                          "Revenue: ₹470.00\n"
+                                          "Cost: ₹329.00\n"
+                                          "Profit: ₹141.00")
+    assert app.generate_demand_insights_text() == "🔥 In-demand: sugar\n❄️ Not in demand: oil"
+
+
+def test_rejected_orders_are_not_counted(app):
+    assert app.add_order("rice", 100, "91") is None
+    assert app.add_order("salt", 1, "91") is None
+    assert app.generate_demand_insights_text() == "📊 No demand data yet."
+
+
+def test_today_totals_reset_on_new_day(app):
+    app.add_order("rice", 2, "91")
+    # pretend the totals were collected yesterday
+    app._sales_agg_date = "2000-01-01"
+    assert app.generate_pnl_summary() == "📊 No sales today."
+    # all-time totals are unaffected
+    assert app.generate_demand_insights_text() == "🔥 In-demand: rice\n❄️ Not in demand: rice"
+
+
+def test_totals_rebuilt_from_disk(app):
+    app.add_order("oil", 3, "91")
+    app.add_order("rice", 1, "91")
+    reloaded = importlib.reload(app)
+    assert reloaded.generate_demand_insights_text() == "🔥 In-demand: oil\n❄️ Not in demand: rice"
+    assert "Revenue: ₹415.00" in reloaded.generate_pnl_summary()